@@ -7,39 +7,57 @@ import uuid
 import tempfile
 import math
 import logging
-from flask import Flask, request, jsonify,send_file
+import re
+import threading
+import time
+from flask import Flask, request, jsonify, send_from_directory
+from werkzeug.exceptions import NotFound
 from dotenv import load_dotenv
 import hashlib
-from Crypto.Cipher import DES3
 from PIL import Image
 import io
-# Optional OCR libs
-try:
-    from passporteye import read_mrz
-    HAVE_PASSEYE = True
-except Exception:
-    HAVE_PASSEYE = False
-
-try:
-    import easyocr
-    HAVE_EASYOCR = True
-    EASY_OCR_READER = easyocr.Reader(["en"], gpu=False)
-except Exception:
-    HAVE_EASYOCR = False
-    EASY_OCR_READER = None
-
-# PaddleOCR is optional; if installed will be used
-try:
-    from paddleocr import PaddleOCR
-    HAVE_PADDLE = True
-    PADDLE_READER = PaddleOCR(use_angle_cls=True, lang="en")
-except Exception:
-    HAVE_PADDLE = False
-    PADDLE_READER = None
+from bac_search import (
+    BAC_SEARCH_HTTP_MAX_CANDIDATES, COMMON_AMBIG, bac_candidates, compute_check_digit, derive_bac_keys, search_bac_key,
+)
 
 load_dotenv()
+# OCR_ENGINE=stub skips loading the real OCR engines and answers every image with
+# a fixed specimen MRZ (after OCR_STUB_DELAY_MS), so load tests are fast and deterministic.
+OCR_ENGINE = os.getenv("OCR_ENGINE", "auto").lower()
+OCR_STUB_DELAY_MS = float(os.getenv("OCR_STUB_DELAY_MS", "0"))
+
+# Optional OCR libs. Not loaded in multiprocessing children that re-import this
+# file as __mp_main__ (BAC search workers only need bac_search).
+if OCR_ENGINE != "stub" and __name__ != "__mp_main__":
+    try:
+        from passporteye import read_mrz
+        HAVE_PASSEYE = True
+    except Exception:
+        HAVE_PASSEYE = False
+
+    try:
+        import easyocr
+        HAVE_EASYOCR = True
+        EASY_OCR_READER = easyocr.Reader(["en"], gpu=False)
+    except Exception:
+        HAVE_EASYOCR = False
+        EASY_OCR_READER = None
+
+    # PaddleOCR is optional; if installed will be used
+    try:
+        from paddleocr import PaddleOCR
+        HAVE_PADDLE = True
+        PADDLE_READER = PaddleOCR(use_angle_cls=True, lang="en")
+    except Exception:
+        HAVE_PADDLE = False
+        PADDLE_READER = None
+else:
+    HAVE_PASSEYE = HAVE_EASYOCR = HAVE_PADDLE = False
+    EASY_OCR_READER = PADDLE_READER = None
+
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 15 * 1024 * 1024
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"
 
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -49,61 +67,6 @@ app.logger.setLevel(logging.INFO)
 
 
 # ---------- MRZ helpers ----------
-_WEIGHTS = [7, 3, 1]
-
-
-def derive_bac_keys(document_number, date_of_birth, date_of_expiry):
-    """
-    Generate BAC key (Kenc, Kmac) from MRZ info according to ICAO 9303 standard.
-    """
-    # 1. Pad document number to 9 characters with '<'
-    doc_num_padded = (document_number + "<" * 9)[:9]
-    
-    # 2. Calculate check digits
-    doc_num_cd = compute_check_digit(doc_num_padded)
-    dob_cd = compute_check_digit(date_of_birth)
-    expiry_cd = compute_check_digit(date_of_expiry)
-    
-    # 3. Construct MRZ information string (24 characters total)
-    # Document number (9) + check digit (1) + DOB (6) + check digit (1) + Expiry (6) + check digit (1)
-    mrz_info = doc_num_padded + doc_num_cd + date_of_birth + dob_cd + date_of_expiry + expiry_cd
-    
-    # 4. Ensure MRZ info is exactly 24 characters
-    if len(mrz_info) != 24:
-        raise ValueError(f"MRZ info should be 24 characters, got {len(mrz_info)}")
-    
-    # 5. Convert to bytes
-    mrz_bytes = mrz_info.encode('utf-8')
-    
-    # 6. Calculate SHA-1 hash
-    sha1_hash = hashlib.sha1(mrz_bytes).digest()
-    
-    # 7. Extract Kenc and Kmac (each 16 bytes)
-    k_enc = sha1_hash[:16]
-    k_mac = sha1_hash[16:32]  # Next 16 bytes
-    
-    # 8. Adjust parity for 3DES keys
-    k_enc = DES3.adjust_key_parity(k_enc)
-    k_mac = DES3.adjust_key_parity(k_mac)
-    
-    return k_enc, k_mac
-
-def char_value(c):
-    if c == "<":
-        return 0
-    if "0" <= c <= "9":
-        return ord(c) - ord("0")
-    if "A" <= c <= "Z":
-        return ord(c) - ord("A") + 10
-    return 0
-
-
-def compute_check_digit(s):
-    total = 0
-    for i, ch in enumerate(s):
-        total += char_value(ch) * _WEIGHTS[i % 3]
-    return str(total % 10)
-
 def clean_mrz_line(line: str) -> str:
     """
     Fix common OCR mistakes in MRZ lines.
@@ -315,6 +278,19 @@ def ocr_with_paddle_img(img_bgr):
     return []
 
 
+STUB_MRZ_LINES = [
+    "P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<",
+    "L898902C36UTO7408122F1204159ZE184226B<<<<<10",
+]
+
+
+def ocr_with_stub(img_bgr):
+    """Stand-in OCR for OCR_ENGINE=stub: ICAO 9303 specimen MRZ, fixed latency."""
+    if OCR_STUB_DELAY_MS > 0:
+        time.sleep(OCR_STUB_DELAY_MS / 1000.0)
+    return list(STUB_MRZ_LINES)
+
+
 # ---------- MRZ parsing TD3 ----------
 def parse_td3(lines):
     out = {}
@@ -387,24 +363,6 @@ def parse_td3(lines):
 
 
 # ---------- Ambiguity-correction solver ----------
-COMMON_AMBIG = {
-    "O": ["0", "O"],
-    "Q": ["0", "Q"],
-    "D": ["0", "D"],
-    "0": ["0", "O", "Q", "D"],
-    "I": ["1", "I", "L"],
-    "L": ["1", "L"],
-    "1": ["1", "I", "L"],
-    "S": ["5", "S"],
-    "5": ["5", "S"],
-    "Z": ["2", "Z"],
-    "2": ["2", "Z"],
-    "B": ["8", "B"],
-    "8": ["8", "B"],
-    "A": ["4", "A"],
-    "4": ["4", "A"],
-}
-
 from itertools import product, combinations
 
 def try_fix_by_checksum(field_str, expected_cd, allow_letters=True, max_positions=6):
@@ -612,7 +570,9 @@ def extract_mrz_route():
             tmp_files.append(t.name)
             # Try passporteye first (gives MRZ-specific parsing often)
             ocr_lines = []
-            if HAVE_PASSEYE:
+            if OCR_ENGINE == "stub":
+                ocr_lines = ocr_with_stub(enhanced_roi)
+            elif HAVE_PASSEYE:
                 try:
                     ocr_lines = ocr_with_passporteye_path(t.name)
                 except Exception:
@@ -669,53 +629,247 @@ def extract_mrz_route():
             except Exception:
                 pass
 
-def base64_to_cv2_img(base64_string: str):
-    """Convert base64 string to OpenCV image"""
+# The request thread blocks while the shared search pool works through the set
+# (inline below BAC_SEARCH_INLINE_MAX). The cap keeps one request to a few
+# CPU-seconds; the semaphore stops overlapping searches from queueing on the pool.
+BAC_SEARCH_HTTP_MAX_CANDIDATES = int(os.getenv("BAC_SEARCH_HTTP_MAX_CANDIDATES", BAC_SEARCH_HTTP_MAX_CANDIDATES))
+_bac_search_slots = threading.BoundedSemaphore(int(os.getenv("BAC_SEARCH_CONCURRENCY", "1")))
+_BAC_FIELDS = ("document_number", "date_of_birth", "date_of_expiry")
+
+
+def _parse_bac_candidates(data):
+    """Candidate tuples from a /bac-search body; raises ValueError on bad input."""
+    limit = BAC_SEARCH_HTTP_MAX_CANDIDATES
+    if data.get("candidates") is not None:
+        raw = data["candidates"]
+        if not isinstance(raw, list):
+            raise ValueError("candidates must be a list")
+        if len(raw) > limit:
+            raise ValueError(f"Too many BAC candidates ({len(raw)} > {limit})")
+        candidates = []
+        for c in raw:
+            if (not isinstance(c, list) or len(c) != 3 or not all(isinstance(f, str) for f in c)
+                    or len(c[1]) != 6 or len(c[2]) != 6):
+                raise ValueError("Each candidate must be [document_number, YYMMDD, YYMMDD] strings")
+            candidates.append(tuple(f.upper() for f in c))
+        return candidates
+
+    for name in _BAC_FIELDS:
+        if not isinstance(data.get(name, ""), str):
+            raise ValueError(f"{name} must be a string")
+        cd = data.get(f"{name}_cd")
+        if cd is not None and not isinstance(cd, str):
+            raise ValueError(f"{name}_cd must be a string")
+    return bac_candidates(
+        data.get("document_number", ""),
+        data.get("date_of_birth", ""),
+        data.get("date_of_expiry", ""),
+        document_number_cd=data.get("document_number_cd"),
+        date_of_birth_cd=data.get("date_of_birth_cd"),
+        date_of_expiry_cd=data.get("date_of_expiry_cd"),
+        limit=limit,
+    )
+
+
+@app.post("/bac-search")
+def bac_search_route():
+    """
+    Offline BAC key search. JSON body:
+      rnd_icc, cryptogram: hex from one GET CHALLENGE / EXTERNAL AUTHENTICATE exchange
+      candidates: [[doc, dob, expiry], ...]  or
+      document_number, date_of_birth, date_of_expiry (+ optional *_cd); '?' marks unreadable chars
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Expected a JSON object"}), 400
+    try:
+        rnd_icc = bytes.fromhex(data.get("rnd_icc", ""))
+        cryptogram = bytes.fromhex(data.get("cryptogram", ""))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "rnd_icc and cryptogram must be hex"}), 400
+
+    try:
+        candidates = _parse_bac_candidates(data)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    if not _bac_search_slots.acquire(blocking=False):
+        return jsonify({"status": "error", "message": "BAC search busy, retry later"}), 429
+    try:
+        result = search_bac_key(rnd_icc, cryptogram, candidates)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    finally:
+        _bac_search_slots.release()
+
+    if not result["found"]:
+        return jsonify({"status": "error", "message": "No candidate matches the transcript", **result}), 404
+    return jsonify({"status": "success", **result})
+
+
+# ---------- Upload store ----------
+# /decode output is stored under the SHA-256 of the submitted image, so concurrent
+# requests never share a path and a repeat upload is just a lookup. A stored
+# name never changes content, which lets /files hand out immutable cache headers.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(512 * 1024 * 1024)))
+UPLOAD_MAX_AGE_SEC = int(os.getenv("UPLOAD_MAX_AGE_SEC", str(7 * 24 * 3600)))
+UPLOAD_EVICT_INTERVAL_SEC = 60
+_STORED_NAME = re.compile(r"^([0-9a-f]{64})\.(png|jpg)$")
+_KEEP_FORMATS = {"PNG": "png", "JPEG": "jpg"}  # served as-is, no re-encode
+_evict_lock = threading.Lock()
+_last_evict = 0.0
+
+
+def base64_to_bytes(base64_string: str):
+    """Decode a (possibly data-URL prefixed) base64 string, or None if invalid"""
     try:
         base64_string = base64_string.replace("\n", "").replace(" ", "")
         if "," in base64_string:  # strip data:image/...;base64,
             base64_string = base64_string.split(",")[1]
-        img_data = base64.b64decode(base64_string)
-        nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        return img
+        return base64.b64decode(base64_string)
     except Exception as e:
         print("Decode error:", e)
         return None
 
 
-@app.route("/decode", methods=["POST"])
-def decode():
-    b64 = request.form.get("b64", "")
+def _jpeg_complete(data):
+    """True if the scan after the last SOS marker is closed by EOI (FFD9 cannot occur inside it)."""
+    sos = data.rfind(b"\xff\xda")
+    return sos != -1 and data.find(b"\xff\xd9", sos) != -1
 
-    img = base64_to_cv2_img(b64)
-    if img is None:
-        return jsonify({"error": "Invalid Base64 image"}), 400
 
-    # Convert OpenCV (BGR) → PIL (RGB)
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    pil_img = Image.fromarray(img_rgb)
+def store_upload(img_bytes):
+    """
+    Store image bytes under their content hash and return the file name,
+    or None if the bytes are not a complete image. PNG/JPEG are written
+    unchanged; anything else OpenCV can read is converted to PNG once.
+    """
+    digest = hashlib.sha256(img_bytes).hexdigest()
+    for ext in _KEEP_FORMATS.values():
+        path = os.path.join(UPLOAD_DIR, f"{digest}.{ext}")
+        try:
+            os.utime(path)  # refresh age for eviction
+            return f"{digest}.{ext}"
+        except FileNotFoundError:
+            continue  # not stored, or evicted just now
 
-    # Save locally in uploads/
-    file_path = os.path.join(UPLOAD_DIR, "decoded.png")
-    pil_img.save(file_path)
+    try:
+        pil_img = Image.open(io.BytesIO(img_bytes))
+        fmt = pil_img.format
+        # PNG: walks every chunk and checks CRCs through IEND. JPEG: only parses
+        # the headers, so completeness is checked via the EOI marker below.
+        pil_img.verify()
+    except Exception:
+        fmt = None
+    if fmt == "JPEG":
+        if not _jpeg_complete(img_bytes):
+            return None  # truncated; libjpeg would still "decode" it, grey-filled
+        if not img_bytes.rstrip(b"\x00").endswith(b"\xff\xd9"):
+            fmt = None  # vendor trailer after EOI: re-encode rather than keep as-is
+    ext = _KEEP_FORMATS.get(fmt)
+    data = img_bytes
+    if ext is None:
+        img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        ok, buf = cv2.imencode(".png", img)
+        if not ok:
+            return None
+        data, ext = buf.tobytes(), "png"
+
+    name = f"{digest}.{ext}"
+    # write-then-rename so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(UPLOAD_DIR, name))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    evict_uploads()
+    return name
+
+
+def evict_uploads(force=False):
+    """
+    Remove stored files older than UPLOAD_MAX_AGE_SEC, then the oldest ones
+    until the store fits in UPLOAD_MAX_BYTES. Runs at most once per
+    UPLOAD_EVICT_INTERVAL_SEC unless forced. Returns the number removed.
+    """
+    global _last_evict
+    now = time.time()
+    if not force and now - _last_evict < UPLOAD_EVICT_INTERVAL_SEC:
+        return 0
+    if not _evict_lock.acquire(blocking=False):
+        return 0
+    try:
+        _last_evict = now
+        entries = []
+        for entry in os.scandir(UPLOAD_DIR):
+            if not _STORED_NAME.match(entry.name):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime <= UPLOAD_MAX_AGE_SEC and total <= UPLOAD_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            app.logger.info("Evicted %d stored uploads (%d bytes left)", removed, total)
+        return removed
+    finally:
+        _evict_lock.release()
+
+
+@app.route("/decode", methods=["POST"])
+def decode():
+    img_bytes = base64_to_bytes(request.form.get("b64", ""))
+    name = store_upload(img_bytes) if img_bytes else None
+    if name is None:
+        return jsonify({"error": "Invalid Base64 image"}), 400
 
     # Return JSON with path (or URL if deployed)
     return jsonify({
         "message": "Image decoded & saved",
-        "file_path": file_path,
-        "file_url": f"/files/decoded.png"  # route to serve it
+        "file_path": os.path.join(UPLOAD_DIR, name),
+        "file_url": f"/files/{name}"  # route to serve it
     })
 
 
 @app.route("/files/<filename>", methods=["GET"])
 def get_file(filename):
-    """Serve saved files back to client"""
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
+    """
+    Serve saved files back to client. Handles If-None-Match (304) and Range (206);
+    the file body goes through the WSGI server's file wrapper (sendfile) or
+    X-Sendfile when USE_X_SENDFILE is set.
+    """
+    stored = _STORED_NAME.match(filename)
+    try:
+        response = send_from_directory(
+            os.path.abspath(UPLOAD_DIR),
+            filename,
+            etag=stored.group(1) if stored else True,
+            max_age=365 * 24 * 3600 if stored else 0,
+        )
+    except NotFound:
         return jsonify({"error": "File not found"}), 404
-    return send_file(file_path, mimetype="image/png")
-
+    if stored:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
 
 
 if __name__ == "__main__":
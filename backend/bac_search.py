@@ -0,0 +1,374 @@
+# bac_search.py
+"""
+MRZ check digits, BAC key derivation (ICAO 9303) and the offline BAC key search.
+
+Kept free of Flask / OpenCV / OCR imports: search workers only need this module,
+so starting them never loads OCR models.
+"""
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+from Crypto.Cipher import DES, DES3
+
+logger = logging.getLogger(__name__)
+
+
+_WEIGHTS = [7, 3, 1]
+
+
+def derive_bac_keys(document_number, date_of_birth, date_of_expiry):
+    """
+    Generate BAC key (Kenc, Kmac) from MRZ info according to ICAO 9303 standard.
+    """
+    # 1. Pad document number to 9 characters with '<'
+    doc_num_padded = (document_number + "<" * 9)[:9]
+    
+    # 2. Calculate check digits
+    doc_num_cd = compute_check_digit(doc_num_padded)
+    dob_cd = compute_check_digit(date_of_birth)
+    expiry_cd = compute_check_digit(date_of_expiry)
+    
+    # 3. Construct MRZ information string (24 characters total)
+    # Document number (9) + check digit (1) + DOB (6) + check digit (1) + Expiry (6) + check digit (1)
+    mrz_info = doc_num_padded + doc_num_cd + date_of_birth + dob_cd + date_of_expiry + expiry_cd
+    
+    # 4. Ensure MRZ info is exactly 24 characters
+    if len(mrz_info) != 24:
+        raise ValueError(f"MRZ info should be 24 characters, got {len(mrz_info)}")
+    
+    # 5. Convert to bytes
+    mrz_bytes = mrz_info.encode('utf-8')
+    
+    # 6. Kseed = first 16 bytes of SHA-1(MRZ info)
+    k_seed = hashlib.sha1(mrz_bytes).digest()[:16]
+    
+    # 7. Kenc / Kmac = first 16 bytes of SHA-1(Kseed || counter)
+    k_enc, k_mac = _bac_kdf(k_seed)
+    
+    return k_enc, k_mac
+
+
+def _bac_kdf(k_seed):
+    """Derive (Kenc, Kmac) from Kseed, with 3DES parity adjusted."""
+    k_enc = hashlib.sha1(k_seed + b"\x00\x00\x00\x01").digest()[:16]
+    k_mac = hashlib.sha1(k_seed + b"\x00\x00\x00\x02").digest()[:16]
+    return DES3.adjust_key_parity(k_enc), DES3.adjust_key_parity(k_mac)
+
+def char_value(c):
+    if c == "<":
+        return 0
+    if "0" <= c <= "9":
+        return ord(c) - ord("0")
+    if "A" <= c <= "Z":
+        return ord(c) - ord("A") + 10
+    return 0
+
+
+def compute_check_digit(s):
+    total = 0
+    for i, ch in enumerate(s):
+        total += char_value(ch) * _WEIGHTS[i % 3]
+    return str(total % 10)
+
+
+COMMON_AMBIG = {
+    "O": ["0", "O"],
+    "Q": ["0", "Q"],
+    "D": ["0", "D"],
+    "0": ["0", "O", "Q", "D"],
+    "I": ["1", "I", "L"],
+    "L": ["1", "L"],
+    "1": ["1", "I", "L"],
+    "S": ["5", "S"],
+    "5": ["5", "S"],
+    "Z": ["2", "Z"],
+    "2": ["2", "Z"],
+    "B": ["8", "B"],
+    "8": ["8", "B"],
+    "A": ["4", "A"],
+    "4": ["4", "A"],
+}
+
+
+# ---------- Offline BAC key search ----------
+# A BAC cryptogram (EXTERNAL AUTHENTICATE command or response data) is
+# E (32 bytes, 3DES-CBC under Kenc) || M (8 bytes, retail MAC under Kmac).
+# With RND.ICC from GET CHALLENGE and one cryptogram made under the real key,
+# every MRZ candidate can be checked offline instead of one NFC round trip each.
+BAC_SEARCH_CHUNK = 2048
+BAC_SEARCH_INLINE_MAX = 4096  # below this, worker start-up costs more than it saves
+BAC_SEARCH_MAX_CANDIDATES = 2_000_000  # offline / benchmark use; the HTTP route uses a lower cap
+BAC_SEARCH_HTTP_MAX_CANDIDATES = 100_000  # default cap for one /bac-search request
+_DOC_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_DIGITS = "0123456789"
+_YYMMDD_TENS = {2: "01", 4: "0123"}
+
+
+def bac_retail_mac(k_mac, data):
+    """ISO 9797-1 MAC algorithm 3 (DES retail MAC), padding method 2."""
+    data = data + b"\x80" + b"\x00" * ((7 - len(data)) % 8)
+    h = DES.new(k_mac[:8], DES.MODE_CBC, iv=bytes(8)).encrypt(data)[-8:]
+    h = DES.new(k_mac[8:16], DES.MODE_ECB).decrypt(h)
+    return DES.new(k_mac[:8], DES.MODE_ECB).encrypt(h)
+
+
+def bac_encrypt(k_enc, k_mac, plain):
+    """Build E || M for a 32-byte BAC plaintext (S or R)."""
+    e = DES3.new(k_enc, DES3.MODE_CBC, iv=bytes(8)).encrypt(plain)
+    return e + bac_retail_mac(k_mac, e)
+
+
+def bac_decrypt(k_enc, k_mac, cryptogram):
+    """Return the 32-byte plaintext of E || M, or None if the MAC does not verify."""
+    e, m = cryptogram[:32], cryptogram[32:40]
+    if bac_retail_mac(k_mac, e) != m:
+        return None
+    return DES3.new(k_enc, DES3.MODE_CBC, iv=bytes(8)).decrypt(e)
+
+
+def bac_cryptogram_matches(k_enc, k_mac, rnd_icc, cryptogram):
+    """
+    True if cryptogram was produced under (k_enc, k_mac) for this challenge.
+    Terminal data is S = RND.IFD || RND.ICC || K.IFD, chip data is
+    R = RND.ICC || RND.IFD || K.ICC, so either side of the exchange works.
+    """
+    try:
+        plain = bac_decrypt(k_enc, k_mac, cryptogram)
+    except ValueError:
+        # degenerate 3DES key (K1 == K2); cannot be the chip's key
+        return False
+    if plain is None:
+        return False
+    return plain[8:16] == rnd_icc or plain[:8] == rnd_icc
+
+
+def _plausible_yymmdd(s):
+    return len(s) == 6 and s.isdigit() and 1 <= int(s[2:4]) <= 12 and 1 <= int(s[4:6]) <= 31
+
+
+def _field_choices(field, allow_letters=True, unknown="?", yymmdd=False):
+    """Per-position character choices for an OCR'd MRZ field."""
+    alphabet = _DOC_CHARS if allow_letters else _DIGITS
+    choices = []
+    for i, ch in enumerate(field.upper()):
+        if ch == unknown:
+            # month / day tens digits of a date can only be 0-1 / 0-3
+            choices.append(_YYMMDD_TENS.get(i, alphabet) if yymmdd else alphabet)
+            continue
+        cands = COMMON_AMBIG.get(ch, [ch])
+        if not allow_letters:
+            cands = [c for c in cands if c.isdigit()] or [ch]
+        choices.append(cands)
+    return choices
+
+
+def _readings(choices, expected_cd):
+    check = expected_cd if expected_cd and expected_cd.isdigit() else None
+    out = []
+    for combo in product(*choices):
+        s = "".join(combo)
+        if check is None or compute_check_digit(s) == check:
+            out.append(s)
+    return out
+
+
+def field_candidates(field, expected_cd=None, allow_letters=True, unknown="?", limit=BAC_SEARCH_MAX_CANDIDATES):
+    """
+    Every reading of an OCR'd MRZ field, not just the first one try_fix_by_checksum finds.
+    Chars in COMMON_AMBIG expand to their look-alikes, `unknown` expands to every legal char.
+    If expected_cd is a digit, only readings matching it are kept.
+    """
+    choices = _field_choices(field, allow_letters, unknown)
+    if math.prod(len(c) for c in choices) > limit:
+        raise ValueError(f"Too many readings for field '{field}'")
+    return _readings(choices, expected_cd)
+
+
+def bac_candidates(document_number, date_of_birth, date_of_expiry,
+                   document_number_cd=None, date_of_birth_cd=None, date_of_expiry_cd=None,
+                   limit=BAC_SEARCH_MAX_CANDIDATES):
+    """
+    Candidate (document_number, date_of_birth, date_of_expiry) tuples for search_bac_key.
+    Dates that cannot be a real YYMMDD are dropped before the cross product.
+    Each field's unfiltered size is checked before it is enumerated; `limit`
+    then applies to the filtered cross product.
+    """
+    fields = (
+        (document_number, document_number_cd, _field_choices(document_number, allow_letters=True)),
+        (date_of_birth, date_of_birth_cd, _field_choices(date_of_birth, allow_letters=False, yymmdd=True)),
+        (date_of_expiry, date_of_expiry_cd, _field_choices(date_of_expiry, allow_letters=False, yymmdd=True)),
+    )
+    for field, _, choices in fields:
+        if math.prod(len(c) for c in choices) > limit:
+            raise ValueError(f"Too many readings for field '{field}'")
+    docs, dobs, exps = (_readings(choices, cd) for _, cd, choices in fields)
+    dobs = [d for d in dobs if _plausible_yymmdd(d)]
+    exps = [d for d in exps if _plausible_yymmdd(d)]
+    if len(docs) * len(dobs) * len(exps) > limit:
+        raise ValueError(f"Too many BAC candidates ({len(docs) * len(dobs) * len(exps)} > {limit})")
+    return list(product(docs, dobs, exps))
+
+
+def _bac_search_chunk(rnd_icc, cryptogram, candidates):
+    """
+    Test one batch of candidates. Returns (index of the match or None, number tested).
+    The SHA-1 state after the document number part is reused across the batch,
+    and check digits are computed once per distinct field value. Only Kmac is
+    derived up front: DES ignores parity bits, so the MAC is checked with the raw
+    key and Kenc (plus the parity adjustment) is paid for on a MAC hit only.
+    """
+    mac_data, mac = cryptogram[:32], cryptogram[32:40]
+    heads = {}
+    tails = {}
+    for i, (doc, dob, exp) in enumerate(candidates):
+        head = heads.get(doc)
+        if head is None:
+            doc_padded = (doc + "<" * 9)[:9]
+            head = hashlib.sha1((doc_padded + compute_check_digit(doc_padded)).encode("utf-8"))
+            heads[doc] = head
+        for d in (dob, exp):
+            if d not in tails:
+                tails[d] = (d + compute_check_digit(d)).encode("utf-8")
+        h = head.copy()
+        h.update(tails[dob] + tails[exp])
+        k_seed = h.digest()[:16]
+        if bac_retail_mac(hashlib.sha1(k_seed + b"\x00\x00\x00\x02").digest()[:16], mac_data) != mac:
+            continue
+        k_enc, k_mac = _bac_kdf(k_seed)
+        if bac_cryptogram_matches(k_enc, k_mac, rnd_icc, cryptogram):
+            return i, i + 1
+    return None, len(candidates)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """
+    Process pool shared by all searches, created on first use. Size comes from
+    BAC_SEARCH_WORKERS (default: min(4, CPUs)). forkserver avoids forking a
+    threaded server process; only this module is preloaded in the workers.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = int(os.getenv("BAC_SEARCH_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if ctx.get_start_method() == "forkserver":
+                ctx.set_forkserver_preload([__name__])
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        return _pool
+
+
+def search_bac_key(rnd_icc, cryptogram, candidates, inline=False, chunk_size=BAC_SEARCH_CHUNK):
+    """
+    Find which (document_number, date_of_birth, date_of_expiry) candidate produced
+    a captured BAC cryptogram. Large sets go to the shared worker pool unless inline=True.
+    Returns a dict with the match (if any), its BAC keys and throughput numbers.
+    """
+    if len(rnd_icc) != 8:
+        raise ValueError("RND.ICC must be 8 bytes")
+    if len(cryptogram) != 40:
+        raise ValueError("BAC cryptogram must be 40 bytes (E || M)")
+    candidates = list(candidates)
+    chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+    match = None
+    tested = 0
+    start = time.perf_counter()
+    if inline or len(candidates) <= BAC_SEARCH_INLINE_MAX:
+        for chunk in chunks:
+            idx, n = _bac_search_chunk(rnd_icc, cryptogram, chunk)
+            tested += n
+            if idx is not None:
+                match = chunk[idx]
+                break
+    else:
+        pool = _get_pool()
+        futures = {pool.submit(_bac_search_chunk, rnd_icc, cryptogram, chunk): chunk for chunk in chunks}
+        try:
+            for fut in as_completed(futures):
+                idx, n = fut.result()
+                tested += n
+                if idx is not None:
+                    match = futures[fut][idx]
+                    break
+        finally:
+            # batches already running finish on their own; queued ones are dropped
+            for fut in futures:
+                fut.cancel()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "found": match is not None,
+        "candidates": len(candidates),
+        "tested": tested,
+        "elapsed_sec": round(elapsed, 4),
+        "candidates_per_sec": int(tested / elapsed) if elapsed > 0 else None,
+    }
+    if match is not None:
+        doc, dob, exp = match
+        k_enc, k_mac = derive_bac_keys(doc, dob, exp)
+        result.update({
+            "document_number": doc,
+            "date_of_birth": dob,
+            "date_of_expiry": exp,
+            "bac_key": {"Kenc": k_enc.hex(), "Kmac": k_mac.hex()},
+        })
+    return result
+
+
+class SimulatedBACChip:
+    """
+    Stand-in for a passport chip that only speaks BAC: GET CHALLENGE and
+    EXTERNAL AUTHENTICATE for a fixed MRZ. Used to produce transcripts for
+    search_bac_key without a real document.
+    """
+
+    def __init__(self, document_number, date_of_birth, date_of_expiry):
+        self.k_enc, self.k_mac = derive_bac_keys(document_number, date_of_birth, date_of_expiry)
+        self.rnd_icc = None
+
+    def get_challenge(self):
+        self.rnd_icc = os.urandom(8)
+        return self.rnd_icc
+
+    def external_authenticate(self, cmd_data):
+        """Return E.ICC || M.ICC, or None where a real chip would answer 6300."""
+        if self.rnd_icc is None:
+            return None
+        plain = bac_decrypt(self.k_enc, self.k_mac, cmd_data)
+        if plain is None or plain[8:16] != self.rnd_icc:
+            return None
+        rnd_ifd = plain[:8]
+        self.rnd_icc, rnd_icc = None, self.rnd_icc
+        return bac_encrypt(self.k_enc, self.k_mac, rnd_icc + rnd_ifd + os.urandom(16))
+
+
+def simulate_bac_transcript(document_number, date_of_birth, date_of_expiry):
+    """Run one successful BAC against a SimulatedBACChip; returns (rnd_icc, chip response)."""
+    chip = SimulatedBACChip(document_number, date_of_birth, date_of_expiry)
+    rnd_icc = chip.get_challenge()
+    cmd_data = bac_encrypt(chip.k_enc, chip.k_mac, os.urandom(8) + rnd_icc + os.urandom(16))
+    return rnd_icc, chip.external_authenticate(cmd_data)
+
+
+def benchmark_bac_search(document_number="L898902C", date_of_birth="69?8?6", date_of_expiry="9?0??3", inline=False):
+    """
+    Time a full miss over the candidate set of an ambiguous MRZ (the worst case,
+    every candidate tested) and return search_bac_key's stats.
+    """
+    rnd_icc, cryptogram = simulate_bac_transcript("X00000000", "000101", "000101")
+    candidates = bac_candidates(document_number, date_of_birth, date_of_expiry)
+    result = search_bac_key(rnd_icc, cryptogram, candidates, inline=inline)
+    logger.info("BAC search: %d candidates in %.3fs (%s/s, inline=%s)",
+                result["tested"], result["elapsed_sec"], result["candidates_per_sec"], inline)
+    return result
@@ -0,0 +1,466 @@
+# loadtest.py
+"""
+Load / soak harness for POST /extract-mrz.
+
+Replays a corpus of images against the backend, either at fixed concurrency
+(closed loop) or at a fixed request rate (open loop), and reports latency
+percentiles, error and 429 rates, and the server's RSS / open-fd trend.
+
+Exits 1 when a threshold is crossed (saturation or leak), 2 on setup errors.
+
+Examples:
+    # local backend with stub OCR, step concurrency to find where it saturates
+    python loadtest.py --stub-ocr --concurrency 1,2,4,8 --duration 20 --max-p99-ms 800
+
+    # 30 min soak at 5 req/s against a running node, watching its process for leaks
+    python loadtest.py --url http://10.0.0.5:5001 --pid 4242 --rate 5 --duration 1800 \\
+        --corpus ./samples --max-rss-growth-mb 50 --max-fd-growth 10
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+# ---------- corpus ----------
+def synthetic_corpus(count=4):
+    """Passport-page-like JPEGs with a rendered MRZ band, for runs without a corpus."""
+    import cv2
+    import numpy as np
+
+    lines = ["P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<", "L898902C36UTO7408122F1204159ZE184226B<<<<<10"]
+    images = []
+    for i in range(count):
+        w, h = 1000 + 80 * i, 700 + 50 * i
+        img = np.full((h, w, 3), 235, np.uint8)
+        cv2.rectangle(img, (40, 60), (300, 380), (180, 180, 180), -1)  # photo
+        for j, line in enumerate(lines):
+            cv2.putText(img, line, (30, h - 120 + 50 * j), cv2.FONT_HERSHEY_SIMPLEX, 0.85, (20, 20, 20), 2)
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if ok:
+            images.append((f"synthetic_{i}.jpg", buf.tobytes()))
+    return images
+
+
+def load_corpus(path):
+    images = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(IMAGE_EXTS):
+            with open(os.path.join(path, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+
+def multipart_body(filename, data):
+    """multipart/form-data body with the image under the 'image' field, as the app sends it."""
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode("utf-8")
+    body = head + data + f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+# ---------- local backend stand-in ----------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_local_backend(port, workdir, stub_ocr=True, stub_delay_ms=0, timeout=60):
+    """
+    Start app.py in a child process (threaded dev server, no reloader) and wait
+    for /health. uploads/ and debug_images/ go to workdir, not the source tree.
+    Returns the Popen; its pid is what the sampler watches.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (BACKEND_DIR, env.get("PYTHONPATH")) if p)
+    if stub_ocr:
+        env["OCR_ENGINE"] = "stub"
+        env["OCR_STUB_DELAY_MS"] = str(stub_delay_ms)
+    code = f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code], cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Backend exited during start-up (code {proc.returncode})")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("Backend did not become healthy in time")
+
+
+# ---------- process sampling ----------
+def read_proc_stats(pid):
+    """(rss_mb, open_fds) for a local pid from /proc, or (None, None) if unavailable."""
+    rss = fds = None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024.0
+                    break
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        pass
+    return rss, fds
+
+
+class ProcSampler(threading.Thread):
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # (t, rss_mb, fds)
+        self._done = threading.Event()
+
+    def run(self):
+        start = time.perf_counter()
+        while not self._done.is_set():
+            rss, fds = read_proc_stats(self.pid)
+            if rss is not None:
+                self.samples.append((time.perf_counter() - start, rss, fds))
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def slope_per_min(points):
+    """Least-squares slope of [(t_sec, value)], in units per minute."""
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mt = sum(t for t, _ in points) / n
+    mv = sum(v for _, v in points) / n
+    var = sum((t - mt) ** 2 for t, _ in points)
+    if var == 0:
+        return 0.0
+    return sum((t - mt) * (v - mv) for t, v in points) / var * 60.0
+
+
+# ---------- load generation ----------
+class Target:
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.path = (parts.path.rstrip("/") or "") + "/extract-mrz"
+        self.timeout = timeout
+
+    def post(self, body, content_type):
+        """Return HTTP status, or 0 for a connection error / timeout."""
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request("POST", self.path, body=body, headers={"Content-Type": content_type})
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        except (OSError, http.client.HTTPException):
+            return 0
+        finally:
+            conn.close()
+
+
+def run_stage(target, payloads, duration, concurrency=None, rate=None, max_in_flight=256):
+    """
+    One load level. Closed loop with `concurrency` workers, or open loop at `rate`
+    req/s; open-loop latency is measured from the scheduled send time, so a
+    backed-up server is not hidden by the client slowing down.
+    Returns [(latency_sec, status, done_at)], done_at in seconds from stage start.
+    """
+    results = []
+    counter = itertools.count()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def one(scheduled):
+        body, ctype = payloads[next(counter) % len(payloads)]
+        status = target.post(body, ctype)
+        done = time.perf_counter()
+        results.append((done - scheduled, status, done - start))
+
+    if rate:
+        interval = 1.0 / rate
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            i = 0
+            while True:
+                scheduled = start + i * interval
+                if scheduled >= deadline:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, scheduled)
+                i += 1
+    else:
+        def worker():
+            while time.perf_counter() < deadline:
+                one(time.perf_counter())
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return results
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    # nearest-rank
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+
+def summarize(results, elapsed, window=None):
+    """
+    404 (no MRZ found) is a normal answer; 429 is counted separately from errors.
+    Open loop passes the send `window`: throughput then counts completions inside
+    it, over the window minus the wait for the first response, so neither the
+    drain of in-flight requests nor the initial latency reads as saturation.
+    The drain is reported as drain_sec.
+    """
+    lat = sorted(r[0] * 1000.0 for r in results)
+    n = len(results)
+    errors = sum(1 for _, s, _ in results if s == 0 or s >= 500 or (400 <= s < 500 and s not in (404, 429)))
+    throttled = sum(1 for _, s, _ in results if s == 429)
+    throughput = n / elapsed if elapsed > 0 else 0.0
+    drain = None
+    if window is not None:
+        done = [r[2] for r in results]
+        first = min(done, default=window)
+        in_window = sum(1 for d in done if d <= window)
+        throughput = in_window / (window - first) if window > first else 0.0
+        drain = round(max(0.0, max(done, default=window) - window), 2)
+    return {
+        "requests": n,
+        "throughput_rps": round(throughput, 2),
+        "drain_sec": drain,
+        "p50_ms": round(percentile(lat, 50), 1) if n else None,
+        "p95_ms": round(percentile(lat, 95), 1) if n else None,
+        "p99_ms": round(percentile(lat, 99), 1) if n else None,
+        "error_rate": round(errors / n, 4) if n else 0.0,
+        "rate_429": round(throttled / n, 4) if n else 0.0,
+    }
+
+
+def stage_violations(stats, args, target_rate=None):
+    out = []
+    if stats["requests"] == 0:
+        out.append("no requests completed")
+        return out
+    if args.max_p99_ms is not None and stats["p99_ms"] > args.max_p99_ms:
+        out.append(f"p99 {stats['p99_ms']}ms > {args.max_p99_ms}ms")
+    if stats["error_rate"] > args.max_error_rate:
+        out.append(f"error rate {stats['error_rate']:.2%} > {args.max_error_rate:.2%}")
+    if stats["rate_429"] > args.max_429_rate:
+        out.append(f"429 rate {stats['rate_429']:.2%} > {args.max_429_rate:.2%}")
+    if target_rate and stats["throughput_rps"] < args.min_rate_ratio * target_rate:
+        out.append(f"throughput {stats['throughput_rps']}/s < {args.min_rate_ratio:.0%} of {target_rate}/s")
+    return out
+
+
+def leak_report(samples, args):
+    """
+    RSS / fd trend after the warm-up window, plus any leak-threshold violations.
+    fd fields are None when /proc/<pid>/fd was not readable (e.g. another user's process).
+    """
+    steady = [s for s in samples if s[0] >= args.warmup] or samples
+    if not steady:
+        return None, []
+    span_min = (steady[-1][0] - steady[0][0]) / 60.0
+    rss_slope = slope_per_min([(t, rss) for t, rss, _ in steady])
+    fd_points = [(t, fds) for t, _, fds in steady if fds is not None]
+    fd_span_min = (fd_points[-1][0] - fd_points[0][0]) / 60.0 if fd_points else 0.0
+    report = {
+        "samples": len(samples),
+        "rss_start_mb": round(steady[0][1], 1),
+        "rss_end_mb": round(steady[-1][1], 1),
+        "rss_peak_mb": round(max(s[1] for s in samples), 1),
+        "rss_slope_mb_per_min": round(rss_slope, 3),
+        "rss_growth_mb": round(rss_slope * span_min, 1),
+        "fds_start": fd_points[0][1] if fd_points else None,
+        "fds_end": fd_points[-1][1] if fd_points else None,
+        "fd_growth": round(slope_per_min(fd_points) * fd_span_min, 1) if fd_points else None,
+    }
+    violations = []
+    if args.max_rss_growth_mb is not None and report["rss_growth_mb"] > args.max_rss_growth_mb:
+        violations.append(f"RSS grew {report['rss_growth_mb']}MB > {args.max_rss_growth_mb}MB")
+    if args.max_fd_growth is not None:
+        if report["fd_growth"] is None:
+            violations.append("open fds not readable, cannot check --max-fd-growth")
+        elif report["fd_growth"] > args.max_fd_growth:
+            violations.append(f"open fds grew by {report['fd_growth']} > {args.max_fd_growth}")
+    return report, violations
+
+
+def check_sampling(pid, args):
+    """
+    Setup error message if a leak threshold is set but cannot be measured, else None.
+    """
+    wanted = [name for name, value in (("--max-rss-growth-mb", args.max_rss_growth_mb),
+                                       ("--max-fd-growth", args.max_fd_growth)) if value is not None]
+    if not wanted:
+        return None
+    if not pid:
+        return f"{', '.join(wanted)} needs the server's --pid when --url is given"
+    rss, fds = read_proc_stats(pid)
+    if rss is None:
+        return f"cannot read /proc/{pid}/status; {', '.join(wanted)} cannot be checked"
+    if fds is None and args.max_fd_growth is not None:
+        return f"cannot read /proc/{pid}/fd (different user?); --max-fd-growth cannot be checked"
+    return None
+
+
+def parse_levels(value, cast):
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Load / soak test for POST /extract-mrz")
+    ap.add_argument("--url", help="backend base URL; default starts a local backend")
+    ap.add_argument("--pid", type=int, help="pid of the backend to sample RSS/fds from (local --url only)")
+    ap.add_argument("--stub-ocr", action="store_true", help="local backend uses OCR_ENGINE=stub")
+    ap.add_argument("--stub-delay-ms", type=float, default=0, help="simulated OCR latency for --stub-ocr")
+    ap.add_argument("--corpus", help="directory of images to replay; default is a synthetic set")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--concurrency", default=None, help="closed-loop workers, comma list for steps (e.g. 1,4,16)")
+    mode.add_argument("--rate", default=None, help="open-loop req/s, comma list for steps (e.g. 2,5,10)")
+    ap.add_argument("--duration", type=float, default=30, help="seconds per step")
+    ap.add_argument("--timeout", type=float, default=30, help="per-request timeout (s)")
+    ap.add_argument("--sample-interval", type=float, default=1.0, help="RSS/fd sampling period (s)")
+    ap.add_argument("--warmup", type=float, default=5.0, help="seconds ignored by the leak check")
+    ap.add_argument("--max-p99-ms", type=float, default=None)
+    ap.add_argument("--max-error-rate", type=float, default=0.01)
+    ap.add_argument("--max-429-rate", type=float, default=0.05)
+    ap.add_argument("--min-rate-ratio", type=float, default=0.9, help="open loop: achieved/target rate floor")
+    ap.add_argument("--max-rss-growth-mb", type=float, default=None)
+    ap.add_argument("--max-fd-growth", type=float, default=None)
+    ap.add_argument("--json", dest="json_out", help="write the full report here")
+    args = ap.parse_args(argv)
+
+    if args.rate:
+        levels = [("rate", r) for r in parse_levels(args.rate, float)]
+    else:
+        levels = [("concurrency", c) for c in parse_levels(args.concurrency or "4", int)]
+
+    images = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    if not images:
+        print("No images in corpus", file=sys.stderr)
+        return 2
+    payloads = [multipart_body(name, data) for name, data in images]
+
+    proc = None
+    sampler = None
+    workdir = tempfile.TemporaryDirectory(prefix="loadtest_")
+    url, pid = args.url, args.pid
+    try:
+        if not url:
+            port = free_port()
+            try:
+                proc = start_local_backend(port, workdir.name, stub_ocr=args.stub_ocr,
+                                           stub_delay_ms=args.stub_delay_ms)
+            except RuntimeError as e:
+                print(str(e), file=sys.stderr)
+                return 2
+            url, pid = f"http://127.0.0.1:{port}", proc.pid
+
+        problem = check_sampling(pid, args)
+        if problem:
+            print(problem, file=sys.stderr)
+            return 2
+        sampler = ProcSampler(pid, args.sample_interval) if pid else None
+        if sampler:
+            sampler.start()
+
+        target = Target(url, args.timeout)
+        stages = []
+        saturation = None
+        for kind, level in levels:
+            t0 = time.perf_counter()
+            if kind == "rate":
+                results = run_stage(target, payloads, args.duration, rate=level)
+            else:
+                results = run_stage(target, payloads, args.duration, concurrency=level)
+            stats = summarize(results, time.perf_counter() - t0,
+                              window=args.duration if kind == "rate" else None)
+            stats[kind] = level
+            stats["violations"] = stage_violations(stats, args, target_rate=level if kind == "rate" else None)
+            stages.append(stats)
+            print(f"{kind}={level:<6} n={stats['requests']:<6} {stats['throughput_rps']:>8}/s  "
+                  f"p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms  "
+                  f"err={stats['error_rate']:.2%} 429={stats['rate_429']:.2%}"
+                  + (f" drain={stats['drain_sec']}s" if stats["drain_sec"] is not None else "")
+                  + (f"  FAIL: {'; '.join(stats['violations'])}" if stats["violations"] else ""))
+            if stats["violations"] and saturation is None:
+                saturation = {kind: level}
+
+        leak, leak_violations = (None, [])
+        if sampler:
+            sampler.stop()
+            leak, leak_violations = leak_report(sampler.samples, args)
+            if leak:
+                print(f"RSS {leak['rss_start_mb']} -> {leak['rss_end_mb']}MB (peak {leak['rss_peak_mb']}, "
+                      f"{leak['rss_slope_mb_per_min']}MB/min), "
+                      + (f"fds {leak['fds_start']} -> {leak['fds_end']}" if leak["fds_start"] is not None
+                         else "fds unavailable")
+                      + (f"  FAIL: {'; '.join(leak_violations)}" if leak_violations else ""))
+    finally:
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        workdir.cleanup()
+
+    report = {
+        "url": url,
+        "corpus_size": len(images),
+        "stages": stages,
+        "saturation_point": saturation,
+        "resources": leak,
+        "resource_violations": leak_violations,
+        "samples": sampler.samples if sampler else [],
+    }
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+    if saturation:
+        print(f"Saturated at {saturation}")
+    return 1 if saturation or leak_violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import pytest
+
+from bac_search import (
+    BAC_SEARCH_HTTP_MAX_CANDIDATES,
+    SimulatedBACChip,
+    bac_candidates,
+    compute_check_digit,
+    derive_bac_keys,
+    search_bac_key,
+    simulate_bac_transcript,
+)
+
+# ICAO 9303 Part 11, Appendix D worked example
+DOC, DOB, EXP = "L898902C", "690806", "940623"
+
+
+def test_derive_bac_keys_icao_example():
+    k_enc, k_mac = derive_bac_keys(DOC, DOB, EXP)
+    assert k_enc.hex() == "ab94fdecf2674fdfb9b391f85d7f76f2"
+    assert k_mac.hex() == "7962d9ece03d1acd4c76089dce131543"
+
+
+def test_search_finds_matching_candidate():
+    rnd_icc, cryptogram = simulate_bac_transcript(DOC, DOB, EXP)
+    candidates = bac_candidates("L8989O2C", "69?806", "94O623")
+    assert (DOC, DOB, EXP) in candidates
+
+    result = search_bac_key(rnd_icc, cryptogram, candidates)
+    assert result["found"]
+    assert (result["document_number"], result["date_of_birth"], result["date_of_expiry"]) == (DOC, DOB, EXP)
+    assert result["bac_key"]["Kenc"] == "ab94fdecf2674fdfb9b391f85d7f76f2"
+
+
+def test_search_miss_tests_every_candidate():
+    rnd_icc, cryptogram = simulate_bac_transcript(DOC, DOB, EXP)
+    candidates = bac_candidates("X1234567", "69?806", "940623")
+
+    result = search_bac_key(rnd_icc, cryptogram, candidates)
+    assert not result["found"]
+    assert result["tested"] == result["candidates"] == len(candidates)
+
+
+def test_simulated_chip_rejects_wrong_cryptogram():
+    chip = SimulatedBACChip(DOC, DOB, EXP)
+    chip.get_challenge()
+    assert chip.external_authenticate(bytes(40)) is None
+
+
+def test_bac_candidates_filters_by_check_digit():
+    # '0' in the document number has four look-alikes; only readings with the
+    # right check digit survive
+    unfiltered = bac_candidates("L8989O2C", DOB, EXP)
+    filtered = bac_candidates("L8989O2C", DOB, EXP, document_number_cd="3")
+    assert len(filtered) < len(unfiltered)
+    assert (DOC, DOB, EXP) in filtered
+    assert all(compute_check_digit((doc + "<" * 9)[:9]) == "3" for doc, _, _ in filtered)
+
+
+def test_bac_candidates_partly_unreadable_dates_fit_http_limit():
+    # unfiltered this is 64 * 8 * 400 readings; the check digits leave a few hundred
+    candidates = bac_candidates(
+        "L898902C", "69?8?6", "9?0??3",
+        document_number_cd="3", date_of_birth_cd="1", date_of_expiry_cd="6",
+        limit=BAC_SEARCH_HTTP_MAX_CANDIDATES,
+    )
+    assert (DOC, DOB, EXP) in candidates
+    assert len(candidates) < 1000
+
+
+def test_bac_candidates_rejects_oversized_input():
+    with pytest.raises(ValueError):
+        bac_candidates("L898902C", "??????", "??????", limit=100_000)
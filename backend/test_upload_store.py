@@ -0,0 +1,114 @@
+import os
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+os.environ.setdefault("OCR_ENGINE", "stub")  # no OCR model loading on import
+import app as backend  # noqa: E402
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(backend, "_last_evict", 0.0)
+    return tmp_path
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (40, 60, 3), dtype=np.uint8)
+
+
+def encode(img, ext):
+    ok, buf = cv2.imencode(ext, img)
+    assert ok
+    return buf.tobytes()
+
+
+def test_repeat_upload_returns_same_name_without_rewrite(upload_dir, image):
+    data = encode(image, ".png")
+    name = backend.store_upload(data)
+    path = upload_dir / name
+    inode = path.stat().st_ino
+    os.utime(path, (1, 1))
+
+    assert backend.store_upload(data) == name
+    assert path.stat().st_ino == inode  # not replaced
+    assert path.stat().st_mtime > 1  # age refreshed for eviction
+
+
+@pytest.mark.parametrize("ext, suffix", [(".png", ".png"), (".jpg", ".jpg")])
+def test_png_and_jpeg_stored_unchanged(upload_dir, image, ext, suffix):
+    data = encode(image, ext)
+    name = backend.store_upload(data)
+    assert name.endswith(suffix)
+    assert (upload_dir / name).read_bytes() == data
+
+
+def test_bmp_converted_to_png(upload_dir, image):
+    name = backend.store_upload(encode(image, ".bmp"))
+    assert name.endswith(".png")
+    stored = cv2.imread(str(upload_dir / name))
+    assert np.array_equal(stored, image)
+
+
+def test_truncated_jpeg_rejected(upload_dir, image):
+    data = encode(image, ".jpg")
+    assert backend.store_upload(data[: len(data) // 2]) is None
+    assert os.listdir(upload_dir) == []
+
+
+def test_jpeg_with_trailer_reencoded(upload_dir, image):
+    name = backend.store_upload(encode(image, ".jpg") + b"TRAILER")
+    assert name.endswith(".png")
+
+
+def test_files_conditional_range_and_cache_headers(upload_dir, image):
+    data = encode(image, ".png")
+    name = backend.store_upload(data)
+    client = backend.app.test_client()
+
+    resp = client.get(f"/files/{name}")
+    assert resp.status_code == 200
+    assert resp.data == data
+    assert resp.headers["ETag"] == f'"{name.split(".")[0]}"'
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert "public" in resp.headers["Cache-Control"]
+    assert "max-age=31536000" in resp.headers["Cache-Control"]
+
+    resp = client.get(f"/files/{name}", headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+    resp = client.get(f"/files/{name}", headers={"Range": "bytes=0-7"})
+    assert resp.status_code == 206
+    assert resp.data == data[:8]
+
+    assert client.get("/files/missing.png").status_code == 404
+
+
+def test_evict_by_age_then_size_oldest_first(upload_dir, monkeypatch):
+    monkeypatch.setattr(backend, "UPLOAD_MAX_AGE_SEC", 1000)
+    monkeypatch.setattr(backend, "UPLOAD_MAX_BYTES", 250)
+    now = time.time()
+    files = {
+        "expired": (now - 5000, 10),
+        "oldest": (now - 300, 100),
+        "middle": (now - 200, 100),
+        "newest": (now - 100, 100),
+    }
+    paths = {}
+    for i, (label, (mtime, size)) in enumerate(files.items()):
+        path = upload_dir / f"{str(i) * 64}.png"
+        path.write_bytes(b"x" * size)
+        os.utime(path, (mtime, mtime))
+        paths[label] = path
+    (upload_dir / "notes.txt").write_bytes(b"x" * 500)  # not a stored name, never evicted
+
+    assert backend.evict_uploads(force=True) == 2
+    assert not paths["expired"].exists()  # too old
+    assert not paths["oldest"].exists()  # 300 bytes > 250, oldest goes first
+    assert paths["middle"].exists() and paths["newest"].exists()
+    assert (upload_dir / "notes.txt").exists()